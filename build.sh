@@ -42,7 +42,6 @@ fpm --verbose \
     -a noarch \
     -n python36-scalable-cuckoo-filter \
     --iteration $RELEASE$DISTRO \
-    -d python36-bitarray \
     -d python36-mmh3     \
     ./setup.py
 
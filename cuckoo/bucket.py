@@ -3,16 +3,41 @@ Cuckoo filter internal bucket.
 '''
 
 import random
+from array import array
+
+
+# The array typecode used to store a fingerprint of a given width (in bits).
+# A fingerprint is stored in the smallest machine type that can hold it
+_TYPECODE_BY_BITS = {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}
+
+# The version of the pickled state of a bucket, it is bumped every time the
+# attributes kept in the state change
+_STATE_VERSION = 1
+
+
+def typecode(fingerprint_bits):
+    '''
+    Return the array typecode of the smallest unsigned integer type that can
+    hold a fingerprint of the given number of bits.
+    '''
+    for bits in sorted(_TYPECODE_BY_BITS):
+        if fingerprint_bits <= bits:
+            return _TYPECODE_BY_BITS[bits]
+
+    raise ValueError('Fingerprint of {} bits is too long'.format(fingerprint_bits))
 
 
 class Bucket():
     '''
     Bucket class for storing fingerprints.
+
+    There could be millions of buckets so they don't have a __dict__, any
+    subclass must also declare its own __slots__ to keep it that way.
     '''
     # https://docs.python.org/3/reference/datamodel.html#object.__slots__
-    __slots__ = ('size', 'bucket')
+    __slots__ = ('bucket', 'count')
 
-    def __init__(self, size=4):
+    def __init__(self, size=4, fingerprint_bits=32):
         '''
         Initialize a dynamic or static bucket to keep a set of Cuckoo
         fingerprints.
@@ -22,45 +47,87 @@ class Bucket():
                 between 0.00001 and 0.002 (see Fan et al.).
               If your targeted FPP is greater than 0.002, a bucket size of 2 is
                 more space efficient.
-        '''
-        self.size = size
 
+        fingerprint_bits: The width of the fingerprints, it is used to pick
+              the smallest integer type to store them.  Default is 32 bits.
+
+        The fingerprint 0 is reserved to mark an empty slot.
+        '''
         # The bucket is implemented as an array cause it's possible to have
-        # multiple items with the same fingerprints
-        self.bucket = []
-        # TODO: investigate a better way to compress the bucket's fingerprints.
-        # It will be very helpful when long fingerprints are need for low error
-        # rate.
+        # multiple items with the same fingerprints.  Fingerprints are fixed
+        # width integers, so they are kept unboxed in a typed array instead
+        # of a list of Python objects.  The array is allocated to its full
+        # size upfront and the number of used slots is tracked separately.
+        # Its length is the size of the bucket, so there is no need to keep
+        # the size in every one of the (potentially millions of) buckets
+        self.bucket = array(typecode(fingerprint_bits), [0]) * size
+        self.count = 0
+
+    @property
+    def size(self):
+        '''
+        The maximum number of fingerprints the bucket can store.
+        '''
+        return len(self.bucket)
+
+    def _to_int(self, fingerprint):
+        '''
+        Convert a fingerprint coming as bytes into the integer as kept by the
+        bucket.  Only its last bytes are kept when it is wider than a slot, so
+        the 16-byte output of mmh3.hash_bytes can be used as it is.
+        '''
+        if isinstance(fingerprint, bytes):
+            return int.from_bytes(fingerprint, 'big') & ((1 << (8 * self.bucket.itemsize)) - 1)
+
+        return fingerprint
 
     def insert(self, fingerprint):
         '''
         Insert a fingerprint into the bucket, the fingerprint basically is just
         a bit vector.  The longer the bit vector, the lower the collision rate.
+        It is stored as an integer, fingerprints coming as bytes are converted.
+        This is the same for all the other methods.
 
         The insertion of duplicate entries is allowed.
         '''
-        if not self.is_full():
-            self.bucket.append(fingerprint)
-            # When the bucket is not full, just append the fingerprint there
+        fingerprint = self._to_int(fingerprint)
+
+        if self.count < len(self.bucket):
+            self.bucket[self.count] = fingerprint
+            self.count += 1
+            # When the bucket is not full, just use the next free slot
             return True
 
         # In static mode, the size of the bucket is fixed.  It means that the
         # filter is reaching its capacity here.
         return False
 
-    def contains(self, fingerprint):
+    def __contains__(self, fingerprint):
         '''
         Check if this bucket contains the provided fingerprint.
         '''
-        return fingerprint in self.bucket
+        # The free slots are all zero and no fingerprint is, so the whole
+        # bucket can be searched without slicing out the used slots
+        fingerprint = self._to_int(fingerprint)
+        return fingerprint != 0 and fingerprint in self.bucket
+
+    # Save a Python frame on lookup, which is the most common operation
+    contains = __contains__
 
     def find_and_replace(self, look_for, replace_with):
         '''
         Find an exact fingerprint the specified bucket and replace it with
         another fingerprint.  Return False if there is no such fingerprint.
         '''
+        look_for = self._to_int(look_for)
+        if look_for == 0:
+            # A free slot doesn't hold any fingerprint
+            return False
+
+        # This is only used to rewind the kicks, in which case the fingerprint
+        # is always there, so a single index() scan is the cheapest option
         try:
-            self.bucket[self.bucket.index(look_for)] = replace_with
+            self.bucket[self.bucket.index(look_for)] = self._to_int(replace_with)
             return True
 
         except ValueError:
@@ -74,32 +141,53 @@ class Bucket():
         Returns True if the fingerprint was present in the bucket. This is
         useful for keeping track of how many items are present in the filter.
         '''
-        try:
-            del self.bucket[self.bucket.index(fingerprint)]
-            return True
-
-        except ValueError:
-            # No such fingerprint in the bucket
+        # Checking first is much cheaper than raising and catching ValueError
+        # from index() when the fingerprint is not here, which is the case for
+        # one of the two buckets an item is looked up from
+        fingerprint = self._to_int(fingerprint)
+        if fingerprint == 0 or fingerprint not in self.bucket:
+            # No such fingerprint in the bucket, the free slots don't count
             return False
 
-    def swap(self, fingerprint):
+        index = self.bucket.index(fingerprint)
+        # The order of fingerprints in a bucket doesn't matter, so just move
+        # the last one into the freed slot instead of shifting
+        self.count -= 1
+        self.bucket[index] = self.bucket[self.count]
+        self.bucket[self.count] = 0
+        return True
+
+    def swap(self, fingerprint, rand=None):
         '''
         Swap a fingerprint with a randomly chosen fingerprint from the bucket.
 
         The given fingerprint is stored in the bucket.
         The swapped fingerprint is returned.
+
+        rand: An optional random number used to pick the fingerprint to swap
+              out.  It should have 8 more bits than the size of the bucket,
+              so that every slot can be picked without much bias.
         '''
         # There is tricky bug in swap function when an item is added several
         # times. In such case, there is a chance that a fingerprint is swapped
         # with itself thus trying to move fingerprints around won't work.
+        # Instead of filtering out all the copies, just move on to the next
+        # slot when the random one holds the same fingerprint.
         #
         # Assuming that the bucket size is 4, the maximum number of times an
         # item can be added is 4 * 2 = 8.
         #
         # TODO: Investigate if there is a better solution for this cause this
         # is a form of local limit of Cuckoo filter.
-        rindex = random.choice([i for i in range(len(self.bucket))
-                                if fingerprint != self.bucket[i]])
+        fingerprint = self._to_int(fingerprint)
+
+        if rand is None:
+            rindex = random.randrange(self.count)
+        else:
+            rindex = rand % self.count
+
+        if self.bucket[rindex] == fingerprint:
+            rindex = (rindex + 1) % self.count
 
         # Swap the two fingerprints
         fingerprint, self.bucket[rindex] = self.bucket[rindex], fingerprint
@@ -111,13 +199,28 @@ class Bucket():
         Signify that the bucket is full, a fingerprint will need to be swapped
         out.
         '''
-        return len(self.bucket) >= self.size
-
-    def __contains__(self, fingerprint):
-        return self.contains(fingerprint)
+        return self.count >= len(self.bucket)
 
     def __repr__(self):
-        return '<Bucket: {0}>'.format(self.bucket)
+        return '<Bucket: {0}>'.format(self.bucket[:self.count].tolist())
 
     def __sizeof__(self):
-        return super().__sizeof__() + sum(f.__sizeof__() for f in self.bucket)
+        # The array is allocated to its full size upfront
+        return super().__sizeof__() + len(self.bucket) * self.bucket.itemsize
+
+    def __getstate__(self):
+        # This allows the bucket to be pickled using protocol 0 and 1 even
+        # though it doesn't have a __dict__
+        return {'bucket': self.bucket, 'count': self.count, 'version': _STATE_VERSION}
+
+    def __setstate__(self, state):
+        version = state.get('version') if isinstance(state, dict) else None
+        if version is None:
+            raise ValueError('Cannot load a Bucket pickled by an older version of cuckoo')
+
+        if version != _STATE_VERSION:
+            raise ValueError('Cannot load a Bucket pickled with the state version {}, expected {}'.format(
+                version, _STATE_VERSION))
+
+        self.bucket = state['bucket']
+        self.count = state['count']
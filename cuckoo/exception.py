@@ -7,11 +7,11 @@ class CapacityException(Exception):
     '''
     Raise when a filter reaches its capacity.
     '''
-    pass
+    __slots__ = ()
 
 
 class InconsistencyException(Exception):
     '''
     Raise when a filter becomes inconsistent.  All bets are off.
     '''
-    pass
+    __slots__ = ()
@@ -11,26 +11,77 @@ Cuckoo filters were originally described in:
     Networking Experiments and Technologies (pp. 75-88). ACM.
 '''
 
-import codecs
-import random
 import math
+import random
+import sys
+from array import array
 from abc import ABCMeta, abstractmethod
 from functools import reduce
 
-from bitarray import bitarray
+try:
+    from pickle import PickleBuffer
+except ImportError:
+    # Out-of-band buffers are only available from Python 3.8 (protocol 5)
+    PickleBuffer = None
+
 import mmh3
 
-from cuckoo.bucket import Bucket
-from cuckoo.exception import CapacityException, InconsistencyException
+from cuckoo.bucket import typecode
+from cuckoo.exception import CapacityException
+
+# The types of the items whose last lookup can be remembered by a filter
+_IMMUTABLE_TYPES = (str, bytes)
+
+# Mark that a filter doesn't remember any lookup, None can't be used here
+# because it could be the item that is looked up
+_MISSING = object()
+
+# The version of the pickled state of the filters, it is bumped every time
+# the attributes kept in the state change
+_STATE_VERSION = 1
+
+
+def _check_state(state, name):
+    '''
+    Make sure that a pickled state can be loaded into a filter of the given
+    class name, raise a ValueError if it comes from another version.
+    '''
+    version = state.get('version') if isinstance(state, dict) else None
+    if version is None:
+        raise ValueError('Cannot load a {} pickled by an older version of cuckoo'.format(name))
+
+    if version != _STATE_VERSION:
+        raise ValueError('Cannot load a {} pickled with the state version {}, expected {}'.format(
+            name, version, _STATE_VERSION))
+
+
+def _typed_buckets(fingerprint_size, size, data=None):
+    '''
+    Allocate size empty slots in a typed array of the smallest integer type
+    that can hold a fingerprint, or take them from the raw bytes in data.
+    '''
+    if data is None:
+        return array(typecode(fingerprint_size), [0]) * size
+
+    buckets = array(typecode(fingerprint_size))
+    buckets.frombytes(data)
+    return buckets
 
 
-class CuckooTemplate():
+# All the attributes are needed by the hot paths, grouping them would only
+# add another lookup there
+class CuckooTemplate():  # pylint: disable=too-many-instance-attributes
     '''
     The base template of a Cuckoo filter.  Do not use this
     directly.
     '''
     __metaclass__ = ABCMeta
 
+    # A scalable Cuckoo filter keeps many filters, so they don't have a
+    # __dict__.  Any subclass must also declare its own __slots__
+    __slots__ = ('capacity', '_mask', 'bucket_size', 'max_kicks', 'error_rate', 'fingerprint_size',
+                 '_fingerprint_mask', '_alt_shift', 'size')
+
     # The default error rate or FP rate of the Cuckoo filter.
     DEFAULT_ERROR_RATE = 0.0001
 
@@ -39,7 +90,7 @@ class CuckooTemplate():
         Initialize Cuckoo filter parameters.
 
         capacity: The size of the filter, it defines how many buckets the
-            filter contains.
+            filter contains.  It is rounded up to the next power of two.
 
         error_rate: The desired error rate, the lower the error rate and the
             bigger the bucket size, the longer the fingerprint needs to be.
@@ -54,7 +105,13 @@ class CuckooTemplate():
             before the filter is considered full.  Defaults to 500 used by
             Fan et al. in the cited paper.
         '''
-        self.capacity = capacity
+        # The number of buckets is always a power of two.  The alternate index
+        # of an item is computed by XOR-ing its index with the hash of its
+        # fingerprint, the result is only guaranteed to be a valid index when
+        # the capacity is a power of two.  This also allows the indices to be
+        # computed using a bit mask instead of a modulo
+        self.capacity = 1 << (capacity - 1).bit_length()
+        self._mask = self.capacity - 1
 
         # NOTE:
         # - If the bucket size increases, a longer fingerprint will be needed
@@ -76,6 +133,12 @@ class CuckooTemplate():
         # bucket size
         min_fp = math.log(1.0/self.error_rate, 2) + math.log(2*self.bucket_size, 2)
         self.fingerprint_size = int(math.ceil(min_fp))
+        self._fingerprint_mask = (1 << self.fingerprint_size) - 1
+
+        # The alternate index is taken from the top bits of the 64-bit product
+        # of the fingerprint and this shift gives just enough bits for the
+        # capacity of the filter
+        self._alt_shift = 64 - (self.capacity.bit_length() - 1)
 
         # The current number of items in the filter
         self.size = 0
@@ -106,27 +169,35 @@ class CuckooTemplate():
         '''
         Calculate the (first) index of an item in the filter.
         '''
-        item_hash = mmh3.hash_bytes(item)
-        # Because of this modular computation, it will be tricky to increase
-        # the capacity of the filter directly
-        return int(codecs.encode(item_hash, 'hex'), 16) % self.capacity
+        # Get the 128-bit hash directly as an integer.  Its low bits are the
+        # first bytes of the hash, which are where the fingerprint comes from,
+        # so the index is taken from its high bits instead.  Because of this
+        # masking, it will be tricky to increase the capacity of the filter
+        # directly
+        return (mmh3.hash128(item, signed=False) >> 64) & self._mask
+
+    def alt_hash(self, fingerprint):
+        '''
+        Hash an integer fingerprint into the filter, an alternate index of an
+        item is its index XOR-ed with this value.  Multiplying by the 64-bit
+        golden ratio and keeping the top bits (Fibonacci hashing) is a lot
+        cheaper than running murmur3 again on the fingerprint, this matters
+        in the kick loop.
+        '''
+        return ((fingerprint * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> self._alt_shift
 
     def indices(self, item, fingerprint):
         '''
-        Calculate all possible indices for the item.  The fingerprint must be a
-        bit array.
+        Calculate all possible indices for the item and return them as a
+        tuple.  The fingerprint must be the integer value as kept by the
+        buckets.
         '''
         index = self.index(item)
-        indices = [index]
 
         # TODO: this is partial-key Cuckoo hashing, investigate if it is
         # possible to devise a novel approach in which there could be more
         # than 2 indices
-        h_value = (index ^ self.index(fingerprint.tobytes())) % self.capacity
-        indices.append(h_value)
-
-        for index in indices:
-            yield index
+        return (index, index ^ self.alt_hash(fingerprint))
 
     def fingerprint(self, item):
         '''
@@ -134,201 +205,53 @@ class CuckooTemplate():
         an item is computed by truncating its Murmur hashing (murmur3) to the
         fingerprint size.
 
-        Return a bit array representation of the fingerprint.
-        '''
-        mmh3_hash = bitarray()
-        mmh3_hash.frombytes(mmh3.hash_bytes(item))
-        # Only get up to the size of the fingerprint
-        return mmh3_hash[:self.fingerprint_size]
-
-    def load_factor(self):
-        '''
-        Provide some useful details about the current state of the filter.
-        '''
-        return round(float(self.size) / (self.capacity * self.bucket_size), 4)
-
-
-class CuckooFilter(CuckooTemplate):
-    '''
-    Implement the text book Cuckoo filter.
-    '''
-    def __init__(self, capacity, error_rate, bucket_size=4, max_kicks=500):
-        '''
-        Initialize Cuckoo filter parameters.
-
-        capacity: The size of the filter, it defines how many buckets the
-            filter contains.
-
-        error_rate: The desired error rate, the lower the error rate and the
-            bigger the bucket size, the longer the fingerprint needs to be.
-
-        bucket_size : The maximum number of fingerprints a bucket can hold.
-            The default size is 4, which closely approaches the best size for
-            FPP between 0.00001 and 0.002 (see Fan et al.).  Also according to
-            the author, if your targeted FPP is greater than 0.002, a bucket
-            size of 2 is more space efficient.
-
-        max_kicks : The number of times entries are kicked / moved around
-            before the filter is considered full.  Defaults to 500 used by
-            Fan et al. in the above paper.
-        '''
-        super(CuckooFilter, self).__init__(capacity,
-                                           error_rate,
-                                           bucket_size,
-                                           max_kicks)
-
-        # Store a list of buckets like such is very Pythonic-ly wasteful cause
-        # there could be millions of such objects and Python object is
-        # unacceptably big.
-        self.buckets = [None] * self.capacity
-
-    def insert(self, item):
-        '''
-        Insert an into the filter, throw an exception if the filter is full
-        and the insertion fails.
+        Return the fingerprint as an integer.  0 is reserved to mark empty
+        slots, so it is never returned.
         '''
-        # Generate the fingerprint in bit array format
-        fingerprint = self.fingerprint(item)
-
-        # Save it here to use it later when all available bucket are full
-        indices = []
-
-        for index in self.indices(item, fingerprint):
-            indices.append(index)
-
-            if self.buckets[index] is None:
-                # Initialize the bucket if needed
-                self.buckets[index] = Bucket(size=self.bucket_size)
-
-            if self.buckets[index].insert(fingerprint):
-                # Update the number of items in the filter
-                self.size = self.size + 1
-                return index
-
-        # If all available buckets are full, we need to kick / move some
-        # fingerprint around
-        index = random.choice(indices)
-
-        # Keep the original index here so that it can be returned later
-        original_index = index
-
-        # Keep all the swapped fingerprints here so we can restore them later
-        fingerprint_stack = [fingerprint]
-        index_stack = [index]
-
-        # TODO: find a way to improve this so that we can minimize the need to
-        # move fingerprints around
-        for _ in range(self.max_kicks):
-            # Swap the item's fingerprint with a fingerprint in the bucket
-            fingerprint = self.buckets[index].swap(fingerprint)
-
-            # Save the swapped fingerprint here so we can restore it later
-            fingerprint_stack.append(fingerprint)
-
-            # Compute the potential bucket to move the swapped fingerprint to
-            index = (index ^ self.index(fingerprint.tobytes())) % self.capacity
-
-            # Save the index here so we can restore it later
-            index_stack.append(index)
-
-            if self.buckets[index] is None:
-                # Initialize the bucket if needed
-                self.buckets[index] = Bucket(size=self.bucket_size)
+        # Only get up to the size of the fingerprint from the low bits of the
+        # hash, the index of the item comes from its high bits
+        fingerprint = mmh3.hash128(item, signed=False) & self._fingerprint_mask
 
-            if self.buckets[index].insert(fingerprint):
-                # Update the number of items in the filter
-                self.size = self.size + 1
-
-                # Return the original index here cause that's where the
-                # original item is saved
-                return original_index
-
-        if len(fingerprint_stack) != len(index_stack):
-            # This is a serious error.  I don't expect this to happen but who
-            # knows.
-            raise InconsistencyException('Cuckoo filter becomes inconsistent')
-
-        # When the filter reaches its capacity, we will rewind the fingerprints
-        # stack and restore them so that there are no change to the list of
-        # existing fingerprints.
-        while len(fingerprint_stack) > 1:
-            fingerprint = fingerprint_stack.pop()
-            index = index_stack.pop()
-
-            if not self.buckets[index_stack[-1]].find_and_replace(look_for=fingerprint_stack[-1],
-                                                                  replace_with=fingerprint):
-                msg = 'Cuckoo filter becomes inconsistent'
-                # This is a serious error. I don't expect this to happen but
-                # who knows
-                raise InconsistencyException(msg)
-
-        msg = 'Cuckoo filter reaches its capacity ({}/{})'.format(self.size, self.capacity)
-        # After restoring fingerprints successfully, raise the capacity
-        # exception
-        raise CapacityException(msg)
+        # Empty slots are all zero, use 1 instead so that this item isn't
+        # mistaken for one
+        return fingerprint or 1
 
-    def contains(self, item):
+    def _split_hash(self, hash_value):
         '''
-        Check if an item is in the filter, return false if it does not exist.
+        Cut both the fingerprint and the (first) index of an item out of its
+        128-bit murmur3 hash, as returned by mmh3.hash128(item, signed=False),
+        the same way as fingerprint and index do.  This saves hashing the item
+        twice.
         '''
-        # Generate the fingerprint in bit array format
-        fingerprint = self.fingerprint(item)
-
-        # TODO: investigate if it is possible to devise a novel approach in
-        # which there could be more than 2 indexes as it is currently used by
-        # partial-key Cuckoo hashing
-        for index in self.indices(item, fingerprint):
-            if self.buckets[index] is None:
-                # Initialize the bucket if needed
-                self.buckets[index] = Bucket(size=self.bucket_size)
-
-            if fingerprint in self.buckets[index]:
-                return True
-
-        return False
+        return (hash_value & self._fingerprint_mask) or 1, (hash_value >> 64) & self._mask
 
-    def delete(self, item):
+    def load_factor(self):
         '''
-        Remove an item from the filter, return false if it does not exist.
+        Provide some useful details about the current state of the filter.
         '''
-        # Generate the fingerprint in bit array format
-        fingerprint = self.fingerprint(item)
-
-        for index in self.indices(item, fingerprint):
-            if self.buckets[index] is None:
-                # Initialize the bucket if needed
-                self.buckets[index] = Bucket(size=self.bucket_size)
-
-            if self.buckets[index].delete(fingerprint):
-                # Update the number of items in the filter
-                self.size = self.size - 1
-                return True
-
-        return False
-
-    def __contains__(self, item):
-        return self.contains(item)
-
-    def __repr__(self):
-        # nopep8
-        return '<CuckooFilter: size={0}, capacity={1}, fingerprint_size={2}, bucket_size={3}>'.format(
-            self.size, self.capacity, self.fingerprint_size, self.bucket_size)
-
-    def __sizeof__(self):
-        return super().__sizeof__() + sum(b.__sizeof__() for b in self.buckets)
+        return round(float(self.size) / (self.capacity * self.bucket_size), 4)
 
 
-class BCuckooFilter(CuckooTemplate):
+# Same as CuckooTemplate, the extra attributes are bound once for the hot paths
+class BCuckooFilter(CuckooTemplate):  # pylint: disable=too-many-instance-attributes
     '''
-    Implement a compact Cuckoo filter using bit array so that it can keep
-    millions of items.
+    Implement a compact Cuckoo filter using a single array of buckets, each
+    packed into a word of just enough bytes for its fingerprints, so that it
+    can keep millions of items.
     '''
+    # Apart from the buckets, the attributes of the filter are either worked
+    # out from the others or only a cache, so they are not pickled
+    _TRANSIENT = ('_stride', '_lane_ones', '_lane_tops',
+                  '_bucket_insert', '_bucket_include', '_bucket_delete', '_bucket_swap',
+                  '_last_item', '_last_result')
+    __slots__ = ('buckets',) + _TRANSIENT
+
     def __init__(self, capacity, error_rate, bucket_size=4, max_kicks=500):
         '''
         Initialize Cuckoo filter parameters.
 
         capacity: The size of the filter, it defines how many buckets the
-            filter contains.
+            filter contains.  It is rounded up to the next power of two.
 
         error_rate: The desired error rate, the lower the error rate and the
             bigger the bucket size, the longer the fingerprint needs to be.
@@ -349,123 +272,293 @@ class BCuckooFilter(CuckooTemplate):
                                             max_kicks)
 
         # The key different here is that the list of buckets is practically
-        # compressed inside a bit array structure.  It solves the memory issue
-        # when Python object is unnecessarily big.  It is a trade-off between
-        # speed and efficiency, using the Bucket class is very easy but
-        # inefficient.
+        # compressed inside a single array.  It solves the memory issue when
+        # Python object is unnecessarily big.  It is a trade-off between speed
+        # and efficiency, using the Bucket class is very easy but inefficient.
         #
-        # The size of the structure will be capacity * bucket_size *
-        # fingerprint_size
-        self.buckets = bitarray(self.capacity * self.bucket_size * self.fingerprint_size)
+        # There will be capacity * bucket_size slots, one per fingerprint.  An
+        # empty slot is 0, which is never a valid fingerprint
+        self._use_buckets(self._new_buckets())
 
-        # Empty the bit array
-        self.buckets.setall(False)
+        # The last item looked up by contains and its result.  The same item
+        # is often checked several times in a row, this saves hashing it and
+        # probing its buckets again.  Any insert or delete forgets it
+        self._forget_last_lookup()
 
-    def _bit_index(self, index):
+    def _packs(self):
         '''
-        Convert a bucket index to its location, bit index, in the bit array.
+        Tell if the buckets are packed into words, which is only done when it
+        takes less memory than a typed array of the smallest integer type that
+        can hold a fingerprint.  For example, a bucket of four 17-bit
+        fingerprints is packed into 9 bytes instead of 16.
         '''
-        sbit = self.bucket_size * self.fingerprint_size * index
-        ebit = self.bucket_size * self.fingerprint_size * (index + 1)
+        try:
+            itemsize = array(typecode(self.fingerprint_size)).itemsize
+        except ValueError:
+            # No integer type is wide enough for the fingerprint
+            return True
 
-        # Return the starting and ending bits of the bucket
-        return (sbit, ebit)
+        return (self.bucket_size * self.fingerprint_size + 7) // 8 < self.bucket_size * itemsize
 
-    def _delete(self, fingerprint, index):
+    def _new_buckets(self, data=None):
         '''
-        Delete a fingerprint from the specified bucket.  Return False if
-        there is no such fingerprint.
+        Allocate all the empty buckets of the filter, or take them from the raw
+        bytes in data.  Packed buckets are kept in a bytearray, the others in a
+        typed array with one item per slot.
         '''
-        start_bit, end_bit = self._bit_index(index)
+        if not self._packs():
+            return _typed_buckets(self.fingerprint_size, self.capacity * self.bucket_size, data)
 
-        for i in range(start_bit, end_bit, self.fingerprint_size):
-            if fingerprint == self.buckets[i:i + self.fingerprint_size]:
-                # Wipe out the fingerprint
-                self.buckets[i:i + self.fingerprint_size] = False
-                return True
+        size = self.capacity * ((self.bucket_size * self.fingerprint_size + 7) // 8)
+        if data is None:
+            return bytearray(size)
 
-        return False
+        if len(data) != size:
+            raise ValueError('{} bytes do not hold {} buckets'.format(len(data), self.capacity))
 
-    def _find_and_replace(self, look_for, replace_with, index):
+        return bytearray(data)
+
+    def _use_buckets(self, buckets):
+        '''
+        Keep the buckets of the filter and pick the fastest way to work on them
+        once for all, so that the hot paths don't have to choose again on every
+        call.
         '''
-        Find an exact fingerprint the specified bucket and replace it with
-        another fingerprint.  Return False if there is no such fingerprint.
+        self.buckets = buckets
+
+        if isinstance(buckets, bytearray):
+            width = self.fingerprint_size
+
+            # The number of bytes of a packed bucket, and the words with a 1 at
+            # the lowest and the highest bit of every slot
+            self._stride = (self.bucket_size * width + 7) // 8
+            self._lane_ones = sum(1 << (slot * width) for slot in range(self.bucket_size))
+            self._lane_tops = self._lane_ones << (width - 1)
+
+            self._bucket_insert = self._insert_packed
+            self._bucket_include = self._include_packed
+            self._bucket_delete = self._delete_packed
+            self._bucket_swap = self._swap_packed
+            return
+
+        # A bucket is bucket_size items of the typed array
+        self._stride = self.bucket_size
+        self._lane_ones = self._lane_tops = 0
+
+        # Use the unrolled version for the default bucket size
+        self._bucket_insert = self._insert_4 if self.bucket_size == 4 else self._insert
+        self._bucket_include = self._include
+        self._bucket_delete = self._delete
+        self._bucket_swap = self._swap
+
+    def _forget_last_lookup(self):
         '''
-        start_bit, end_bit = self._bit_index(index)
+        Forget the last item looked up by contains, this must be called every
+        time the buckets change.
+        '''
+        self._last_item = _MISSING
+        self._last_result = False
 
-        for i in range(start_bit, end_bit, self.fingerprint_size):
-            if look_for == self.buckets[i:i + self.fingerprint_size]:
-                # Replace it with another fingerprint
-                self.buckets[i:i + self.fingerprint_size] = replace_with
-                return True
+    def _delete(self, fingerprint, index):
+        '''
+        Delete a fingerprint from the specified bucket.  Return False if
+        there is no such fingerprint.
+        '''
+        buckets = self.buckets
+        bucket_size = self.bucket_size
 
-        return False
+        start = index * bucket_size
+        bucket = buckets[start:start + bucket_size]
+
+        if fingerprint not in bucket:
+            return False
+
+        # Wipe out the fingerprint
+        buckets[start + bucket.index(fingerprint)] = 0
+        return True
 
     def _include(self, fingerprint, index):
         '''
         Check if a fingerprint exists in the bucket at the specified index.
         '''
-        start_bit, end_bit = self._bit_index(index)
-
-        for i in range(start_bit, end_bit, self.fingerprint_size):
-            if fingerprint == self.buckets[i:i + self.fingerprint_size]:
-                return True
-
-        return False
+        start = index * self.bucket_size
+        return fingerprint in self.buckets[start:start + self.bucket_size]
 
     def _insert(self, fingerprint, index):
         '''
         Insert a fingerprint into the bucket at the specified index. Basically,
-        it set the corresponding bits in the bucket:
+        it set the first empty slot in the bucket:
 
                 Bucket               Bucket
         ------------------------------------------ ...
         | F1 | F2 | F3 | F4 || F1 | F2 | F3 | F4 |
 
-        When the bucket is full (all bits are set), the function will return
+        When the bucket is full (no slot is 0), the function will return
         False.
         '''
-        start_bit, end_bit = self._bit_index(index)
+        buckets = self.buckets
+        bucket_size = self.bucket_size
 
-        for i in range(start_bit, end_bit, self.fingerprint_size):
-            stored_fingerprint = self.buckets[i:i + self.fingerprint_size]
+        start = index * bucket_size
 
-            if stored_fingerprint.count(True):
-                # Continue the fingerprint has been set (having a bit set)
-                continue
+        try:
+            # Empty slots are exactly 0, so the first one can be found with a
+            # single scan of the bucket
+            slot = buckets[start:start + bucket_size].index(0)
+        except ValueError:
+            # All fingerprints have been set, the bucket is full
+            return False
 
-            self.buckets[i:i + self.fingerprint_size] = fingerprint
-            # An empty slot has been found, save the fingerprint there
-            return True
+        # An empty slot has been found, save the fingerprint there
+        buckets[start + slot] = fingerprint
+        return True
 
-        # All fingerprints have been set, the bucket is full
-        return False
+    def _insert_4(self, fingerprint, index):
+        '''
+        Same as _insert but unrolled for the default bucket size of 4, the
+        first empty slot is found without slicing the bucket.
+        '''
+        buckets = self.buckets
+        start = index * 4
+
+        if not buckets[start]:
+            buckets[start] = fingerprint
+        elif not buckets[start + 1]:
+            buckets[start + 1] = fingerprint
+        elif not buckets[start + 2]:
+            buckets[start + 2] = fingerprint
+        elif not buckets[start + 3]:
+            buckets[start + 3] = fingerprint
+        else:
+            # All fingerprints have been set, the bucket is full
+            return False
 
-    def _swap(self, fingerprint, index):
+        return True
+
+    def _swap(self, fingerprint, index, rand):
         '''
         Swap a fingerprint with a random fingerprint of the bucket at the
-        specified index.
+        specified index.  The random number rand is used to pick the swapped
+        out fingerprint.
         '''
-        start_bit, end_bit = self._bit_index(index)
+        buckets = self.buckets
+        bucket_size = self.bucket_size
 
-        size = self.fingerprint_size
-        # Get the bit index of a random fingerprint in the bucket
-        rindex = random.choice([i for i in range(start_bit, end_bit, size)
-                                if fingerprint != self.buckets[i:i + size]])
+        start = index * bucket_size
 
         # There is tricky bug in swap function when an item is added several
         # times. In such case, there is a chance that a fingerprint is swapped
         # with itself thus trying to move fingerprints around won't work.
+        # Instead of filtering out all the copies, just move on to the next
+        # slot when the random one holds the same fingerprint.
         #
         # Assuming that the bucket size is 4, the maximum number of times an
         # item can be added is 4 * 2 = 8.
         #
         # TODO: Investigate if there is a better solution for this cause this
         # is a form of local limit of Cuckoo filter.
+        slot = rand % bucket_size
+        if buckets[start + slot] == fingerprint:
+            slot = (slot + 1) % bucket_size
+
+        # Get the index of a random fingerprint in the bucket
+        rindex = start + slot
+
+        # Swap the two fingerprints
+        swap_out = buckets[rindex]
+        buckets[rindex] = fingerprint
+
+        # and return the one from the bucket
+        return swap_out
+
+    def _read_packed(self, index):
+        '''
+        Read the packed bucket at the specified index as a single word, its
+        first slot is in the lowest bits.
+        '''
+        stride = self._stride
+        start = index * stride
+        return int.from_bytes(self.buckets[start:start + stride], 'little')
+
+    def _write_packed(self, index, word):
+        '''
+        Write the packed bucket at the specified index from a single word.
+        '''
+        stride = self._stride
+        start = index * stride
+        self.buckets[start:start + stride] = word.to_bytes(stride, 'little')
+
+    def _find_packed(self, word, fingerprint):
+        '''
+        Return the position of the lowest bit of the first slot of the word
+        holding the fingerprint, or -1 if there is none.  Pass 0 as the
+        fingerprint to find an empty slot.
+
+        XOR-ing the fingerprint into every slot zeroes the ones holding it.
+        Zero slots are then flagged all at once by the usual SWAR trick, the
+        first flag is always right while the ones after could be wrong.
+        '''
+        word ^= fingerprint * self._lane_ones
+        flags = (word - self._lane_ones) & ~word & self._lane_tops
+
+        # The flag is the highest bit of the slot
+        return (flags & -flags).bit_length() - self.fingerprint_size if flags else -1
+
+    def _include_packed(self, fingerprint, index):
+        '''
+        Same as _include but for a packed bucket.
+        '''
+        return self._find_packed(self._read_packed(index), fingerprint) >= 0
+
+    def _insert_packed(self, fingerprint, index):
+        '''
+        Same as _insert but for a packed bucket, the fingerprint is set in the
+        first empty slot.
+        '''
+        word = self._read_packed(index)
+        shift = self._find_packed(word, 0)
+
+        if shift < 0:
+            # All fingerprints have been set, the bucket is full
+            return False
+
+        self._write_packed(index, word | (fingerprint << shift))
+        return True
+
+    def _delete_packed(self, fingerprint, index):
+        '''
+        Same as _delete but for a packed bucket.
+        '''
+        word = self._read_packed(index)
+        shift = self._find_packed(word, fingerprint)
+
+        if shift < 0:
+            return False
+
+        # Wipe out the fingerprint
+        self._write_packed(index, word ^ (fingerprint << shift))
+        return True
+
+    def _swap_packed(self, fingerprint, index, rand):
+        '''
+        Same as _swap but for a packed bucket.
+        '''
+        width = self.fingerprint_size
+        mask = self._fingerprint_mask
+        bucket_size = self.bucket_size
+
+        word = self._read_packed(index)
+
+        # Move on to the next slot when the random one holds the same
+        # fingerprint, see _swap
+        slot = rand % bucket_size
+        swap_out = (word >> (slot * width)) & mask
+        if swap_out == fingerprint:
+            slot = (slot + 1) % bucket_size
+            swap_out = (word >> (slot * width)) & mask
 
         # Swap the two fingerprints
-        swap_out = self.buckets[rindex:rindex + self.fingerprint_size]
-        self.buckets[rindex:rindex + self.fingerprint_size] = fingerprint
+        self._write_packed(index, word ^ ((swap_out ^ fingerprint) << (slot * width)))
 
         # and return the one from the bucket
         return swap_out
@@ -475,47 +568,76 @@ class BCuckooFilter(CuckooTemplate):
         Insert an into the filter, throw an exception if the filter is full and
         the insertion fails.
         '''
-        # Generate the fingerprint in bit array format
-        fingerprint = self.fingerprint(item)
+        # The filter is about to change, forget the last lookup
+        self._forget_last_lookup()
 
-        # Save it here to use it later when all available bucket are full
-        indices = []
+        # Generate the fingerprint, an integer as kept by the buckets, and the
+        # index of the item from a single hash
+        hash_value = mmh3.hash128(item, signed=False)
+        fingerprint, index = self._split_hash(hash_value)
+
+        insert = self._bucket_insert
 
-        for index in self.indices(item, fingerprint):
-            indices.append(index)
+        # Save it here to use it later when all available bucket are full
+        indices = (index, index ^ self.alt_hash(fingerprint))
 
-            if self._insert(fingerprint, index):
+        for index in indices:
+            if insert(fingerprint, index):
                 # Update the number of items in the filter
                 self.size = self.size + 1
                 return index
 
         # If all available buckets are full, we need to kick / move some
-        # fingerprints around
-        index = random.choice(indices)
+        # fingerprints around.  The top bit of the hash is used neither by the
+        # fingerprint nor by the index, so it works as a free coin flip to
+        # pick the bucket to start with
+        return self._kick(fingerprint, indices[hash_value >> 127])
+
+    def _kick(self, fingerprint, index):
+        '''
+        Insert a fingerprint when both its buckets are full by kicking / moving
+        some fingerprints around, starting from the bucket at the specified
+        index.  Return that index, throw an exception if the filter is full and
+        the insertion fails.
+        '''
+        insert = self._bucket_insert
 
         # Keep the original index here so that it can be returned later
         original_index = index
 
-        # Keep all the swapped fingerprints here so we can restore them later
-        fingerprint_stack = [fingerprint]
-        index_stack = [index]
+        # Keep a copy of every bucket before its first swap so that they can
+        # all be restored at once if the filter turns out to be full
+        snapshots = {}
+
+        # Everything used by each kick is bound here once
+        alt_shift = self._alt_shift
+        swap = self._bucket_swap
 
         # TODO: find a way to improve this so that we can minimize the need to
-        # move fingerprints around
+        # move fingerprints around.  Draw all the random numbers needed to
+        # pick the fingerprints to swap out at once.  Each kick takes 8 more
+        # bits than needed to number the slots, so that every slot can be
+        # picked and the modulo bias stays below 1/256.  They come from the
+        # random module so that seeding it reproduces the same kicks
+        bits = self.bucket_size.bit_length() + 8
+        rand_mask = (1 << bits) - 1
+        rands = random.getrandbits(bits * self.max_kicks) if self.max_kicks else 0
+
         for _ in range(self.max_kicks):
-            # Swap the item's fingerprint with a fingerprint in the bucket
-            fingerprint = self._swap(fingerprint, index)
+            rand = rands & rand_mask
+            rands >>= bits
 
-            # Save the swapped fingerprint here so we can restore it later
-            fingerprint_stack.append(fingerprint)
+            if index not in snapshots:
+                snapshots[index] = self._snapshot(index)
 
-            # Compute the potential bucket to move the swapped fingerprint to
-            index = (index ^ self.index(fingerprint.tobytes())) % self.capacity
+            # Swap the item's fingerprint with a fingerprint in the bucket
+            fingerprint = swap(fingerprint, index, rand)
 
-            # Save the index here so we can restore it later
-            index_stack.append(index)
+            # Compute the potential bucket to move the swapped fingerprint to.
+            # This is alt_hash written inline to save a method call per kick
+            index = index ^ (((fingerprint * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> alt_shift)
 
-            if self._insert(fingerprint, index):
+            if insert(fingerprint, index):
                 # Update the number of items in the filter
                 self.size = self.size + 1
 
@@ -523,53 +645,134 @@ class BCuckooFilter(CuckooTemplate):
                 # original item is saved
                 return original_index
 
-        if len(fingerprint_stack) != len(index_stack):
-            # This is a serious error.  I don't expect this to happen but
-            # who knows.
-            raise InconsistencyException('Cuckoo filter becomes inconsistent')
-
-        # When the filter reaches its capacity, we will rewind the fingerprints
-        # stack and restore them so that there are no change to the list of
-        # existing fingerprints.
-        while len(fingerprint_stack) > 1:
-            fingerprint = fingerprint_stack.pop()
-            index = index_stack.pop()
-
-            if not self._find_and_replace(look_for=fingerprint_stack[-1],
-                                          replace_with=fingerprint,
-                                          index=index_stack[-1]):
-                # This is a serious error.  I don't expect this to happen
-                raise InconsistencyException('Cuckoo filter becomes inconsistent')
+        # When the filter reaches its capacity, put back all the swapped
+        # buckets so that there are no change to the list of existing
+        # fingerprints.  Only swaps modify a bucket here, a failed insert
+        # doesn't
+        self._restore(snapshots)
 
         msg = 'Cuckoo filter reaches its capacity ({}/{})'.format(self.size, self.capacity)
         # After restoring fingerprints successfully, raise the capacity exception
         raise CapacityException(msg)
 
+    def _snapshot(self, index):
+        '''
+        Return a copy of the raw bucket at the specified index, packed or not.
+        '''
+        start = index * self._stride
+        return self.buckets[start:start + self._stride]
+
+    def _restore(self, snapshots):
+        '''
+        Put back the copies of the buckets taken by _snapshot, keyed by their
+        indices.
+        '''
+        buckets = self.buckets
+        stride = self._stride
+
+        for kicked, saved in snapshots.items():
+            start = kicked * stride
+            buckets[start:start + stride] = saved
+
+    def insert_many(self, items):
+        '''
+        Insert many items into the filter at once, return the list of their
+        indices in the same order.  This saves the per-item method calls of
+        insert in the common case when one of the two buckets of an item still
+        has an empty slot.  Throw an exception if the filter is full, all the
+        items before the failed one stay in the filter.
+        '''
+        # The filter is about to change, forget the last lookup
+        self._forget_last_lookup()
+
+        insert = self._bucket_insert
+        split_hash = self._split_hash
+        alt_hash = self.alt_hash
+
+        results = []
+        for item in items:
+            hash_value = mmh3.hash128(item, signed=False)
+            fingerprint, index = split_hash(hash_value)
+
+            if not insert(fingerprint, index):
+                indices = (index, index ^ alt_hash(fingerprint))
+                index = indices[1]
+
+                if not insert(fingerprint, index):
+                    # Both buckets are full, move some fingerprints around
+                    # starting from the same bucket as insert would
+                    results.append(self._kick(fingerprint, indices[hash_value >> 127]))
+                    continue
+
+            # Update the number of items in the filter
+            self.size = self.size + 1
+            results.append(index)
+
+        return results
+
     def contains(self, item):
         '''
         Check if an item is in the filter, return false if it does not exist.
         '''
-        # Generate the fingerprint in bit array format
-        fingerprint = self.fingerprint(item)
+        if item is self._last_item:
+            return self._last_result
 
-        # TODO: investigate if it is possible to devise a novel approach in
-        # which there could be more than 2 indexes as it is currently used by
-        # partial-key Cuckoo hashing
-        for i in self.indices(item, fingerprint):
-            if self._include(fingerprint, i):
-                return True
+        result = self._contains_prehashed(mmh3.hash128(item, signed=False))
 
-        return False
+        # Only remember immutable items, the buffer behind a memoryview could
+        # be different the next time it is looked up
+        if type(item) in _IMMUTABLE_TYPES:
+            self._last_item = item
+            self._last_result = result
+
+        return result
+
+    def _contains_prehashed(self, hash_value):
+        '''
+        Same as contains but take the 128-bit murmur3 hash of the item, as
+        returned by mmh3.hash128(item, signed=False), instead of the item.
+        The fingerprint and the index are both cut from this single hash, so
+        a scalable Cuckoo filter only needs to hash an item once to query all
+        its filters.
+        '''
+        fingerprint, index = self._split_hash(hash_value)
+
+        if self._bucket_include(fingerprint, index):
+            return True
+
+        return self._bucket_include(fingerprint, index ^ self.alt_hash(fingerprint))
+
+    def contains_many(self, items):
+        '''
+        Check if each of the items is in the filter, return a list of booleans
+        in the same order.  This saves the per-item method calls of contains
+        when querying many items at once.
+        '''
+        include = self._bucket_include
+        split_hash = self._split_hash
+        alt_hash = self.alt_hash
+
+        results = []
+        for item in items:
+            # Hash the item only once for both its fingerprint and its index
+            fingerprint, index = split_hash(mmh3.hash128(item, signed=False))
+            results.append(include(fingerprint, index) or include(fingerprint, index ^ alt_hash(fingerprint)))
+
+        return results
 
     def delete(self, item):
         '''
         Remove an item from the filter, return false if it does not exist.
         '''
-        # Generate the fingerprint in bit array format
-        fingerprint = self.fingerprint(item)
+        # The filter is about to change, forget the last lookup
+        self._forget_last_lookup()
 
-        for index in self.indices(item, fingerprint):
-            if self._delete(fingerprint, index):
+        # Generate the fingerprint, an integer as kept by the buckets, and the
+        # index of the item from a single hash
+        fingerprint, index = self._split_hash(mmh3.hash128(item, signed=False))
+
+        for index in (index, index ^ self.alt_hash(fingerprint)):
+            if self._bucket_delete(fingerprint, index):
                 # Update the number of items in the filter
                 self.size = self.size - 1
                 return True
@@ -583,12 +786,87 @@ class BCuckooFilter(CuckooTemplate):
         return '<BCuckooFilter: size={0}, capacity={1}, fingerprint_size={2}, bucket_size={3}>'.format(
             self.size, self.capacity, self.fingerprint_size, self.bucket_size)
 
+    def __sizeof__(self):
+        # All fingerprints are kept in a single array, so there is no need to
+        # go through the buckets one by one
+        return super().__sizeof__() + self.buckets.__sizeof__()
+
+    def __getstate__(self):
+        # Save all the attributes except for the last lookup, which is only a
+        # cache, and the ways to work on the buckets, which are set up again
+        # when loading.  This also allows the filter to be pickled using
+        # protocol 0 and 1 even though it doesn't have a __dict__
+        state = {name: getattr(self, name) for cls in type(self).__mro__ for name in getattr(cls, '__slots__', ())}
+        for name in BCuckooFilter._TRANSIENT:
+            del state[name]
+
+        state['version'] = _STATE_VERSION
+        return state
+
+    def __setstate__(self, state):
+        _check_state(state, type(self).__name__)
+
+        for name, value in state.items():
+            if name not in ('version', 'byteorder'):
+                setattr(self, name, value)
+
+        buckets = self.buckets
+        packs = self._packs()
+        if not isinstance(buckets, bytearray if packs else array):
+            # The buckets come as a raw buffer when using pickle protocol 5
+            buckets = self._new_buckets(memoryview(buckets).cast('B'))
+
+            # The raw slots of a typed array could come from a machine with a
+            # different byte order
+            if not packs and state.get('byteorder', sys.byteorder) != sys.byteorder:
+                buckets.byteswap()
+
+        self._use_buckets(buckets)
+        self._forget_last_lookup()
+
+    def __reduce_ex__(self, protocol):
+        if protocol < 5 or PickleBuffer is None:
+            return super().__reduce_ex__(protocol)
+
+        state = self.__getstate__()
+        # Hand over the slots as a buffer instead of a copy of the array, so
+        # that they can be transferred out-of-band using a buffer callback
+        state['buckets'] = PickleBuffer(self.buckets)
+
+        # Packed buckets are in the same byte order on every machine, but the
+        # slots of a typed array are in the byte order of this machine
+        if isinstance(self.buckets, array):
+            state['byteorder'] = sys.byteorder
+        return (object.__new__, (type(self),), state)
+
+
+class CuckooFilter(BCuckooFilter):
+    '''
+    Implement the basic Cuckoo filter.  It used to keep a list of Bucket
+    objects, which is very Pythonic-ly wasteful cause there could be millions
+    of such objects and Python object is unacceptably big.  So it now shares
+    the single array of the compact Cuckoo filter, but its buckets are never
+    packed: every fingerprint takes a whole slot of a typed array.
+    '''
+    __slots__ = ()
+
+    def _packs(self):
+        # Each slot is the smallest integer type that can hold a fingerprint
+        return False
+
+    def __repr__(self):
+        # nopep8
+        return '<CuckooFilter: size={0}, capacity={1}, fingerprint_size={2}, bucket_size={3}>'.format(
+            self.size, self.capacity, self.fingerprint_size, self.bucket_size)
+
 
 class ScalableCuckooFilter():
     '''
     Implement a scalable Cuckoo filter which has the ability to extend its
     capacity dynamically.
     '''
+    __slots__ = ('filters', '_frozen')
+
     SCALE_FACTOR = 2
 
     # The original work shows that a Cuckoo filter can have a load factor up
@@ -603,7 +881,8 @@ class ScalableCuckooFilter():
         Initialize Cuckoo filter parameters.
 
         initial_capacity: The initial size of the filter, it defines how many
-            buckets the first filter contains.
+            buckets the first filter contains.  It is rounded up to the next
+            power of two.
 
         error_rate: The desired error rate, the lower the error rate and the
             bigger the bucket size, the longer the fingerprint needs to be.
@@ -624,12 +903,22 @@ class ScalableCuckooFilter():
         # Initialize the first Cuckoo filter
         self.filters.append(BCuckooFilter(initial_capacity, error_rate, bucket_size, max_kicks))
 
+        # The positions of the filters which have failed to insert an item.
+        # They are not tried again until something is removed from them, or
+        # else every insert would pay for all the kicks of a failed insert
+        # again before moving on
+        self._frozen = set()
+
     def insert(self, item):
         '''
         Insert an into the filter, when the filter approaches its capacity,
         increasing it.
         '''
-        for cuckoo in reversed(self.filters):
+        for position in range(len(self.filters) - 1, -1, -1):
+            if position in self._frozen:
+                continue
+
+            cuckoo = self.filters[position]
             # Do not wait until the capacity exception is raised cause it will
             # degrade the filter performance by having too many fingerprints
             # being moved around. If a filter has a load factor larger than
@@ -644,8 +933,8 @@ class ScalableCuckooFilter():
                 return cuckoo.insert(item)
 
             except CapacityException:
-                # Fail to insert the item
-                pass
+                # Fail to insert the item, don't try this filter again
+                self._frozen.add(position)
 
         last_filter = self.filters[-1]
         # Fail to insert the item in all available filters, create a new one
@@ -656,7 +945,11 @@ class ScalableCuckooFilter():
         error_rate = last_filter.error_rate
         max_kicks = last_filter.max_kicks
 
-        # Create a new Cuckoo filter with more capacity
+        # Create a new Cuckoo filter with more capacity.  The old filters are
+        # kept as they are: their fingerprints can't be moved into the new one
+        # because an extra bit of the original hash is needed to tell which
+        # of the two doubled buckets a fingerprint belongs to, and only the
+        # fingerprints are kept
         self.filters.append(BCuckooFilter(capacity, error_rate, bucket_size, max_kicks))
 
         # Add the item into the new and bigger filter
@@ -666,20 +959,45 @@ class ScalableCuckooFilter():
         '''
         Check if an item is in the filter, return false if it does not exist.
         '''
+        # All filters share the same hash function, so the item is hashed
+        # only once here
+        hash_value = mmh3.hash128(item, signed=False)
+
         for cuckoo in reversed(self.filters):
-            if item in cuckoo:
+            # An empty filter can be skipped right away
+            # pylint: disable=protected-access
+            if cuckoo.size and cuckoo._contains_prehashed(hash_value):
                 return True
 
         return False
 
+    def contains_many(self, items):
+        '''
+        Check if each of the items is in the filter, return a list of booleans
+        in the same order.  Each item is still hashed only once for all the
+        filters.
+        '''
+        # Empty filters can never match, so they are left out once here
+        # instead of being checked again for every item
+        filters = [cuckoo for cuckoo in reversed(self.filters) if cuckoo.size]
+
+        results = []
+        for item in items:
+            hash_value = mmh3.hash128(item, signed=False)
+            # pylint: disable=protected-access
+            results.append(any(cuckoo._contains_prehashed(hash_value) for cuckoo in filters))
+
+        return results
+
     def delete(self, item):
         '''
         Remove an item from the filter, return false if it does not exist.
         '''
         # Using this naive approach, items can be removed from old filters
         # make them them under capacity (usable) again
-        for cuckoo in reversed(self.filters):
-            if cuckoo.delete(item):
+        for position in range(len(self.filters) - 1, -1, -1):
+            if self.filters[position].delete(item):
+                self._frozen.discard(position)
                 return True
 
         return False
@@ -696,3 +1014,17 @@ class ScalableCuckooFilter():
 
     def __sizeof__(self):
         return super().__sizeof__() + sum(f.__sizeof__() for f in self.filters)
+
+    def __getstate__(self):
+        # This allows the filter to be pickled using protocol 0 and 1 even
+        # though it doesn't have a __dict__
+        state = {name: getattr(self, name) for cls in type(self).__mro__ for name in getattr(cls, '__slots__', ())}
+        state['version'] = _STATE_VERSION
+        return state
+
+    def __setstate__(self, state):
+        _check_state(state, type(self).__name__)
+
+        for name, value in state.items():
+            if name != 'version':
+                setattr(self, name, value)
@@ -4,11 +4,23 @@ Test Cuckoo bucket.
 
 import unittest
 
-from bitarray import bitarray
 from netaddr import IPAddress
 
 import mmh3
-from cuckoo.bucket import Bucket
+from cuckoo.bucket import Bucket, typecode
+
+
+# Convert the IP addresses used by the tests into their integer format only
+# once instead of in every test case
+_IP = {ip: str(int(IPAddress(ip))) for ip in ('192.168.1.{}'.format(i) for i in range(190, 196))}
+
+# Generate all the fingerprints at once, the bucket keeps them as 32-bit
+# integers by default so the 32-bit murmur3 hash is enough
+_FINGERPRINT = {item: mmh3.hash(item, signed=False) for item in list(_IP) + list(_IP.values())}
+
+# The action of a test case, an index into the tuple of actions of the tested
+# bucket
+INSERT, DELETE = 0, 1
 
 
 class BucketTest(unittest.TestCase):
@@ -22,165 +34,73 @@ class BucketTest(unittest.TestCase):
         '''
         bucket = Bucket()
 
-        # By default, a bucket has the capacity of 4
-        cases = [
-            {
-                'item': '192.168.1.190',
-                'transformer': lambda string: string,
-
-                'action': bucket.insert,
-                'expected': True,
-
-                'full': False,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.191',
-                'transformer': lambda string: str(int(IPAddress(string))),
-
-                'action': bucket.insert,
-                'expected': True,
-
-                'full': False,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-
-                'action': bucket.insert,
-                'expected': True,
-
-                'full': False,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-
-                'action': bucket.insert,
-                'expected': True,
-
-                'full': True,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.194',
-                'transformer': lambda string: string,
-
-                'action': bucket.insert,
-                'expected': False,
-
-                'full': True,
-                'included': False,
-            },
-
-            {
-                'item': '192.168.1.195',
-                'transformer': lambda string: str(int(IPAddress(string))),
-
-                'action': bucket.insert,
-                'expected': False,
-
-                'full': True,
-                'included': False,
-            },
-
-            {
-                'item': '192.168.1.195',
-                'transformer': lambda string: str(int(IPAddress(string))),
-
-                'action': bucket.delete,
-                'expected': False,
-
-                'full': True,
-                'included': False,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-
-                'action': bucket.delete,
-                'expected': True,
-
-                'full': False,
-                'included': False,
-            },
-
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-
-                'action': bucket.delete,
-                'expected': True,
-
-                'full': False,
-                'included': False,
-            },
-
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-
-                'action': bucket.insert,
-                'expected': True,
-
-                'full': False,
-                'included': True,
-            },
-
+        actions = (bucket.insert, bucket.delete)
+
+        # Each case is an item, the action, its expected result, whether the
+        # bucket is full afterward and whether the item is in the bucket.  By
+        # default, a bucket has the capacity of 4
+        cases = (
+            ('192.168.1.190', INSERT, True, False, True),
+            (_IP['192.168.1.191'], INSERT, True, False, True),
+            ('192.168.1.192', INSERT, True, False, True),
+            (_IP['192.168.1.193'], INSERT, True, True, True),
+            ('192.168.1.194', INSERT, False, True, False),
+            (_IP['192.168.1.195'], INSERT, False, True, False),
+            (_IP['192.168.1.195'], DELETE, False, True, False),
+            ('192.168.1.192', DELETE, True, False, False),
+            (_IP['192.168.1.193'], DELETE, True, False, False),
+            (_IP['192.168.1.193'], INSERT, True, False, True),
             # Add the same item again
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-
-                'action': bucket.insert,
-                'expected': True,
-
-                'full': True,
-                'included': True,
-            },
-
+            (_IP['192.168.1.193'], INSERT, True, True, True),
             # Remove a duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-
-                'action': bucket.delete,
-                'expected': True,
-
-                'full': False,
-                'included': True,
-            },
-
+            (_IP['192.168.1.193'], DELETE, True, False, True),
             # Remove the last copy of the duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
+            (_IP['192.168.1.193'], DELETE, True, False, False),
+        )
 
-                'action': bucket.delete,
-                'expected': True,
+        for item, action, expected, full, included in cases:
+            fingerprint = _FINGERPRINT[item]
 
-                'full': False,
-                'included': False,
-            },
-        ]
+            self.assertEqual(actions[action](fingerprint), expected, 'Save {0} into the bucket ok'.format(item))
+            self.assertEqual(bucket.is_full(), full, 'Bucket capacity is ok')
 
-        for case in cases:
-            item = case['transformer'](case['item'])
+            # Make sure that all items are in the bucket
+            self.assertEqual(bucket.contains(fingerprint), included, 'Item {0} is in the bucket'.format(item))
+            self.assertEqual(fingerprint in bucket, included, 'Item {0} is in the bucket'.format(item))
 
-            # Generate all the fingerprints
-            fingerprint = bitarray()
-            fingerprint.frombytes(mmh3.hash_bytes(item))
+        # The free slots are zero but they don't hold any fingerprint
+        bucket = Bucket()
+        self.assertFalse(0 in bucket, 'An empty bucket holds nothing')
+        self.assertFalse(bucket.delete(0), 'Nothing to remove from an empty bucket')
+        self.assertFalse(bucket.find_and_replace(0, 1), 'Nothing to replace in an empty bucket')
+        self.assertEqual(bucket.count, 0, 'An empty bucket stays empty')
 
-            self.assertEqual(case['action'](fingerprint), case['expected'], 'Save {0} into the bucket ok'.format(item))
-            self.assertEqual(bucket.is_full(), case['full'], 'Bucket capacity is ok')
 
-            # Make sure that all items are in the bucket
-            self.assertEqual(bucket.contains(fingerprint), case['included'], 'Item {0} is in the bucket'.format(item))
-            self.assertEqual(fingerprint in bucket, case['included'], 'Item {0} is in the bucket'.format(item))
+    def test_fingerprint_width(self):
+        '''
+        Fingerprints are stored in the smallest integer type that fits them.
+        '''
+        self.assertEqual(typecode(7), 'B', 'A 7-bit fingerprint fits in a byte')
+        self.assertEqual(typecode(16), 'H', 'A 16-bit fingerprint fits in a short')
+        self.assertEqual(typecode(23), 'I', 'A 23-bit fingerprint fits in an int')
+        self.assertRaises(ValueError, typecode, 65)
+
+        bucket = Bucket(size=2, fingerprint_bits=16)
+        self.assertEqual(bucket.bucket.typecode, 'H', 'Bucket uses the narrowest type')
+
+        # Fingerprints coming as bytes are stored as integers
+        self.assertTrue(bucket.insert(b'\x01\x02'), 'Save a bytes fingerprint into the bucket ok')
+        self.assertTrue(0x0102 in bucket, 'Bytes fingerprint is stored as an integer')
+        self.assertTrue(b'\x01\x02' in bucket, 'Bytes fingerprint can be looked up as bytes')
+        self.assertTrue(bucket.find_and_replace(b'\x01\x02', b'\x03\x04'), 'Bytes fingerprint can be replaced')
+        self.assertTrue(bucket.contains(0x0304), 'Bytes fingerprint is replaced')
+
+        # A fingerprint wider than a slot is cut down to its last bytes
+        fingerprint = mmh3.hash_bytes('192.168.1.190')
+        self.assertTrue(bucket.insert(fingerprint), 'Save a 16-byte fingerprint into the bucket ok')
+        self.assertTrue(bucket.is_full(), 'Bucket capacity is ok')
+        self.assertTrue(fingerprint in bucket, 'Wide bytes fingerprint is in the bucket')
+        self.assertEqual(bucket.swap(b'\x05\x06', 0), 0x0304, 'Bytes fingerprint can be swapped in')
+        self.assertTrue(bucket.delete(fingerprint), 'Wide bytes fingerprint can be removed')
+        self.assertTrue(bucket.delete(b'\x05\x06'), 'Swapped bytes fingerprint can be removed')
+        self.assertFalse(bucket.delete(b'\x05\x06'), 'Bytes fingerprint is removed')
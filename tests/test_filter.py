@@ -3,11 +3,23 @@ Test Cuckoo filter
 '''
 
 import os
+import random
+import sys
 import timeit
 import unittest
 
 from netaddr import IPAddress
 from cuckoo.filter import CuckooFilter, BCuckooFilter, ScalableCuckooFilter
+from cuckoo.exception import CapacityException
+
+
+# Convert the IP addresses used by the tests into their integer format only
+# once instead of in every test case
+_IP = {ip: str(int(IPAddress(ip))) for ip in ('192.168.1.{}'.format(i) for i in range(190, 196))}
+
+# The action of a test case, an index into the tuple of actions of the tested
+# filter
+INSERT, DELETE = 0, 1
 
 
 class CuckooTest(unittest.TestCase):
@@ -32,91 +44,300 @@ class CuckooTest(unittest.TestCase):
 
         cuckoo = CuckooFilter(capacity, error_rate)
 
-        # By default, a bucket has the capacity of 4
-        cases = [
-            {
-                'item': '192.168.1.190',
-                'transformer': lambda string: string,
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.191',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-                'action': cuckoo.delete,
-                'included': False,
-            },
-
+        # Each case is an item, the action and whether the item is in the filter
+        # afterward.  By default, a bucket has the capacity of 4
+        cases = (
+            ('192.168.1.190', INSERT, True),
+            (_IP['192.168.1.191'], INSERT, True),
+            ('192.168.1.192', INSERT, True),
+            (_IP['192.168.1.193'], INSERT, True),
+            ('192.168.1.192', DELETE, False),
             # Add the same item again
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
+            (_IP['192.168.1.193'], INSERT, True),
             # Remove a duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.delete,
-                'included': True,
-            },
-
+            (_IP['192.168.1.193'], DELETE, True),
             # Remove the last copy of the duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.delete,
-                'included': False,
-            },
-        ]
+            (_IP['192.168.1.193'], DELETE, False),
+        )
 
-        for case in cases:
-            item = case['transformer'](case['item'])
+        actions = (cuckoo.insert, cuckoo.delete)
 
-            self.assertTrue(case['action'](item), 'Insert / delete {0} from the filter ok'.format(item))
+        for item, action, included in cases:
+            self.assertTrue(actions[action](item), 'Insert / delete {0} from the filter ok'.format(item))
 
             # Make sure that all items are in the bucket
-            self.assertEqual(cuckoo.contains(item), case['included'], 'Item {0} is in the filter'.format(item))
-            self.assertEqual(item in cuckoo, case['included'], 'Item {0} is in the bucket'.format(item))
+            self.assertEqual(cuckoo.contains(item), included, 'Item {0} is in the filter'.format(item))
+            self.assertEqual(item in cuckoo, included, 'Item {0} is in the bucket'.format(item))
 
         # Test the bitarray Cuckoo filter
         bcuckoo = BCuckooFilter(capacity, error_rate)
 
-        for case in cases:
-            # Use the method from bit array Cuckoo filter
-            case['action'] = bcuckoo.insert if case['action'] == cuckoo.insert else bcuckoo.delete
-
-            item = case['transformer'](case['item'])
+        # Use the methods from bit array Cuckoo filter
+        actions = (bcuckoo.insert, bcuckoo.delete)
 
-            self.assertTrue(case['action'](item), 'Insert / delete {0} from the filter ok'.format(item))
+        for item, action, included in cases:
+            self.assertTrue(actions[action](item), 'Insert / delete {0} from the filter ok'.format(item))
 
             # Make sure that all items are in the bucket
-            self.assertEqual(bcuckoo.contains(item), case['included'], 'Item {0} is in the filter'.format(item))
-            self.assertEqual(item in bcuckoo, case['included'], 'Item {0} is in the bucket'.format(item))
+            self.assertEqual(bcuckoo.contains(item), included, 'Item {0} is in the filter'.format(item))
+            self.assertEqual(item in bcuckoo, included, 'Item {0} is in the bucket'.format(item))
+
+
+    def test_contains_many(self):
+        '''
+        Query many items from the bitarray Cuckoo filter at once.
+        '''
+        bcuckoo = BCuckooFilter(128, 0.000001)
+
+        items = ['192.168.1.{}'.format(i) for i in range(190, 200)]
+        for item in items[:5]:
+            bcuckoo.insert(item)
+
+        expected = [bcuckoo.contains(item) for item in items]
+        self.assertEqual(expected[:5], [True] * 5, 'All inserted items are in the filter')
+        self.assertEqual(bcuckoo.contains_many(items), expected, 'Batch lookup matches single lookups')
+        self.assertEqual(bcuckoo.contains_many([]), [], 'Nothing to look up')
+
+
+    def test_insert_many(self):
+        '''
+        Insert many items into the Cuckoo filters at once.
+        '''
+        items = [str(i) for i in range(400)]
+
+        for cls in (CuckooFilter, BCuckooFilter):
+            cuckoo = cls(128, 0.000001)
+            other = cls(128, 0.000001)
+
+            indices = cuckoo.insert_many(items)
+            self.assertEqual(len(indices), len(items), 'All items get an index')
+            self.assertEqual(cuckoo.size, len(items), 'Size of {0} is ok'.format(cls.__name__))
+            self.assertEqual(cuckoo.contains_many(items), [True] * len(items), 'All items are in the filter')
+
+            # Items are put in their first bucket whenever possible, the same
+            # as inserting them one by one
+            self.assertEqual(indices[:100], [other.insert(item) for item in items[:100]], 'Batch insert matches')
+            self.assertEqual(cuckoo.insert_many([]), [], 'Nothing to insert')
+
+            # Once both buckets of an item are full, its fingerprint is kicked
+            # around the same way as it would be by insert
+            random.seed(0)
+            cuckoo = cls(128, 0.000001)
+            indices = cuckoo.insert_many(items)
+
+            random.seed(0)
+            other = cls(128, 0.000001)
+            self.assertEqual(indices, [other.insert(item) for item in items], 'Batch insert with kicks matches')
+            self.assertEqual(bytes(cuckoo.buckets), bytes(other.buckets), 'Fingerprints are kicked the same way')
+
+            # The kick path is taken when the filter is close to its capacity
+            with self.assertRaises(CapacityException):
+                cuckoo.insert_many([str(-i) for i in range(1000)])
+
+            self.assertEqual(cuckoo.contains_many(items), [True] * len(items), 'All items stay in the filter')
+
+
+    def test_repeated_lookup(self):
+        '''
+        Looking up the same item again gives the same result, even after the
+        filter has changed in between.
+        '''
+        for cls in (CuckooFilter, BCuckooFilter):
+            cuckoo = cls(128, 0.000001)
+            item = '192.168.1.190'
+
+            self.assertFalse(cuckoo.contains(item), 'Item is not in {0}'.format(cls.__name__))
+            self.assertFalse(cuckoo.contains(item), 'Item is still not in {0}'.format(cls.__name__))
+
+            cuckoo.insert(item)
+            self.assertTrue(cuckoo.contains(item), 'Item is in {0}'.format(cls.__name__))
+            self.assertTrue(item in cuckoo, 'Item is still in {0}'.format(cls.__name__))
+
+            cuckoo.delete(item)
+            self.assertFalse(cuckoo.contains(item), 'Item is removed from {0}'.format(cls.__name__))
+
+            cuckoo.insert_many([item])
+            self.assertTrue(cuckoo.contains(item), 'Item is in {0} again'.format(cls.__name__))
+
+            # None is never mistaken for the last item looked up, it can't be
+            # hashed at all
+            cuckoo.delete(item)
+            self.assertRaises(TypeError, cuckoo.contains, None)
+
+            # A failed lookup doesn't leave a stale result behind either
+            cuckoo.insert(item)
+            self.assertTrue(cuckoo.contains(item), 'Item is in {0} once more'.format(cls.__name__))
+            cuckoo.delete(item)
+            self.assertFalse(cuckoo.contains(item), 'Item is removed from {0} again'.format(cls.__name__))
+
+            # Equal but distinct bytes objects are the same item
+            data, other = b'192.168.1.191', bytes(bytearray(b'192.168.1.191'))
+            self.assertIsNot(data, other)
+
+            cuckoo.insert(data)
+            self.assertTrue(cuckoo.contains(data), 'Bytes are in {0}'.format(cls.__name__))
+            self.assertTrue(cuckoo.contains(other), 'Equal bytes are in {0}'.format(cls.__name__))
+            cuckoo.delete(other)
+            self.assertFalse(cuckoo.contains(data), 'Bytes are removed from {0}'.format(cls.__name__))
+            self.assertFalse(cuckoo.contains(other), 'Equal bytes are removed from {0}'.format(cls.__name__))
+
+
+    def test_false_positive_rate(self):
+        '''
+        The false positive rate of the filters stays within the error rate.
+        '''
+        error_rate = 0.001
+        items = [str(i) for i in range(2000)]
+        others = [str(-i) for i in range(1, 20001)]
+
+        for cls in (CuckooFilter, BCuckooFilter):
+            # Keep the filter half full
+            cuckoo = cls(1024, error_rate)
+            for item in items:
+                cuckoo.insert(item)
+
+            false_positives = sum(1 for item in others if item in cuckoo)
+            self.assertLess(false_positives, error_rate * len(others) * 2,
+                            'False positive rate of {0} is ok'.format(cls.__name__))
+
+
+    def test_fingerprint_width(self):
+        '''
+        Fingerprints are exactly as wide as the fingerprint size.
+        '''
+        for error_rate, width in ((0.01, 10), (0.000001, 23)):
+            cuckoo = BCuckooFilter(128, error_rate)
+            self.assertEqual(cuckoo.fingerprint_size, width, 'The fingerprint size comes from the error rate')
+
+            fingerprints = [cuckoo.fingerprint(str(i)) for i in range(100)]
+            self.assertTrue(all(0 < f < 1 << width for f in fingerprints), 'Fingerprints fit in their size')
+            self.assertTrue(any(f >= 1 << (width - 1) for f in fingerprints), 'Fingerprints use all their bits')
+
+
+    def test_capacity(self):
+        '''
+        The capacity of a filter is rounded up to the next power of two.
+        '''
+        for cls in (CuckooFilter, BCuckooFilter):
+            self.assertEqual(cls(128, 0.000001).capacity, 128, 'A power of two capacity is kept as it is')
+            self.assertEqual(cls(100, 0.000001).capacity, 128, 'The capacity is rounded up to a power of two')
+            self.assertEqual(cls(1, 0.000001).capacity, 1, 'A filter can have a single bucket')
+
+
+    def test_full_filter(self):
+        '''
+        A failed insertion leaves the filter as it was.
+        '''
+        for cls in (CuckooFilter, BCuckooFilter):
+            cuckoo = cls(8, 0.000001, max_kicks=20)
+
+            with self.assertRaises(CapacityException):
+                for i in range(1000):
+                    before = bytes(cuckoo.buckets)
+                    cuckoo.insert(str(i))
+
+            self.assertEqual(bytes(cuckoo.buckets), before,
+                             'All fingerprints in {0} are restored'.format(cls.__name__))
+            self.assertEqual(cuckoo.size, i, 'Size of {0} is ok'.format(cls.__name__))
+
+            for j in range(i):
+                self.assertTrue(str(j) in cuckoo, 'Item {0} is still in {1}'.format(j, cls.__name__))
+
+
+    def test_seeded_kicks(self):
+        '''
+        Seeding the random module reproduces the same kicks.
+        '''
+        for cls in (CuckooFilter, BCuckooFilter):
+            filled = []
+            for _ in range(2):
+                random.seed(0)
+                cuckoo = cls(64, 0.000001, max_kicks=20)
+
+                try:
+                    for i in range(1000):
+                        cuckoo.insert(str(i))
+                except CapacityException:
+                    pass
+
+                filled.append((cuckoo.size, bytes(cuckoo.buckets)))
+
+            self.assertEqual(filled[0], filled[1], 'Kicks in {0} are reproducible'.format(cls.__name__))
+
+
+    def test_large_buckets(self):
+        '''
+        Kicks can swap out any slot of a large bucket.
+        '''
+        for cls in (CuckooFilter, BCuckooFilter):
+            cuckoo = cls(1, 0.000001, bucket_size=300)
+            for i in range(300):
+                cuckoo.insert(str(i))
+
+            # Record the slot picked by every kick
+            # pylint: disable=protected-access
+            slots = []
+            swap = cuckoo._bucket_swap
+
+            def record(fingerprint, index, rand, swap=swap):
+                slots.append(rand % 300)
+                return swap(fingerprint, index, rand)
+
+            cuckoo._bucket_swap = record
+            self.assertRaises(CapacityException, cuckoo.insert, '300')
+            self.assertEqual(len(slots), cuckoo.max_kicks, 'All the kicks of {} are tried'.format(cls.__name__))
+            self.assertGreaterEqual(max(slots), 256, 'Kicks in {} reach the last slots'.format(cls.__name__))
+
+
+    def test_packed_buckets(self):
+        '''
+        Packed buckets hold the same fingerprints in the same slots as a typed
+        array.
+        '''
+        for error_rate, bucket_size in ((0.000001, 4), (0.01, 2), (0.001, 3), (0.000001, 8)):
+            filled = []
+            for cls in (CuckooFilter, BCuckooFilter):
+                random.seed(0)
+                cuckoo = cls(64, error_rate, bucket_size=bucket_size, max_kicks=20)
+
+                try:
+                    for i in range(1000):
+                        cuckoo.insert(str(i))
+                except CapacityException:
+                    pass
+
+                deleted = [cuckoo.delete(str(i)) for i in range(0, 1000, 3)]
+                found = cuckoo.contains_many([str(i) for i in range(1000)])
+                filled.append((cuckoo.size, deleted, found, cuckoo.buckets))
+
+            width = cuckoo.fingerprint_size
+            self.assertIsInstance(cuckoo.buckets, bytearray, 'The compact filter packs {}-bit slots'.format(width))
+
+            # Unpack every slot of every bucket, the first one is in the lowest bits
+            stride = len(cuckoo.buckets) // cuckoo.capacity
+            words = [int.from_bytes(cuckoo.buckets[i:i + stride], 'little')
+                     for i in range(0, len(cuckoo.buckets), stride)]
+            slots = [(word >> (slot * width)) & ((1 << width) - 1) for word in words for slot in range(bucket_size)]
+
+            self.assertEqual(filled[1][:3], filled[0][:3], 'Packed buckets behave as typed ones')
+            self.assertEqual(slots, filled[0][3].tolist(), 'Packed buckets hold the same fingerprints')
+
+
+    def test_sizeof(self):
+        '''
+        The size of a filter accounts for all its slots.
+        '''
+        cuckoo = CuckooFilter(1024, 0.000001)
+        # 1024 buckets of 4 slots, each 32-bit wide to hold a 23-bit fingerprint
+        self.assertGreater(sys.getsizeof(cuckoo), 1024 * 4 * 4, 'Size of the classic filter is ok')
+
+        cuckoo = BCuckooFilter(1024, 0.000001)
+        # The same slots packed 4 by 4 into 12-byte words
+        self.assertGreater(sys.getsizeof(cuckoo), 1024 * 4 * 23 // 8, 'Size of the compact filter is ok')
+        self.assertLess(sys.getsizeof(cuckoo), 1024 * 4 * 4, 'The compact filter packs its slots')
+
+        cuckoo = ScalableCuckooFilter(1024, 0.000001)
+        self.assertGreater(sys.getsizeof(cuckoo), 1024 * 4 * 23 // 8, 'Size of the scalable filter is ok')
 
 
     # pylint: disable=no-self-use
@@ -134,6 +355,16 @@ class CuckooTest(unittest.TestCase):
                                         number=number)
         print('# Pre-allocate 100_000_000 buckets in: {}'.format(round(float(allocation_time) / number, 4)))
 
+        # The compact filter packs its buckets while the classic one keeps a
+        # typed array, both insert and look up the same items
+        items = [str(i) for i in range(30000)]
+        for cls in (CuckooFilter, BCuckooFilter, ScalableCuckooFilter):
+            cuckoo = cls(16384, 0.0001)
+            insert_time = timeit.timeit(lambda: [cuckoo.insert(item) for item in items], number=1)
+            contains_time = timeit.timeit(lambda: [item in cuckoo for item in items], number=1)
+            print('# {}: insert 30_000 items in {}, look them up in {}'.format(
+                cls.__name__, round(insert_time, 4), round(contains_time, 4)))
+
 
     def test_dynamic_capacity_filter(self):
         '''
@@ -146,73 +377,62 @@ class CuckooTest(unittest.TestCase):
 
         cuckoo = ScalableCuckooFilter(capacity, error_rate, bucket_size=1)
 
-        # By default, a bucket has the capacity of 4
-        cases = [
-            {
-                'item': '192.168.1.190',
-                'transformer': lambda string: string,
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.191',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-                'action': cuckoo.delete,
-                'included': False,
-            },
-
+        # Each case is an item, the action and whether the item is in the filter
+        # afterward.  By default, a bucket has the capacity of 4
+        cases = (
+            ('192.168.1.190', INSERT, True),
+            (_IP['192.168.1.191'], INSERT, True),
+            ('192.168.1.192', INSERT, True),
+            (_IP['192.168.1.193'], INSERT, True),
+            ('192.168.1.192', DELETE, False),
             # Add the same item again
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-                'included': True,
-            },
-
+            (_IP['192.168.1.193'], INSERT, True),
             # Remove a duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.delete,
-                'included': True,
-            },
-
+            (_IP['192.168.1.193'], DELETE, True),
             # Remove the last copy of the duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.delete,
-                'included': False,
-            },
-        ]
+            (_IP['192.168.1.193'], DELETE, False),
+        )
 
-        for case in cases:
-            item = case['transformer'](case['item'])
+        actions = (cuckoo.insert, cuckoo.delete)
 
-            self.assertIsNotNone(case['action'](item), 'Save {0} into the filter ok'.format(item))
+        for item, action, included in cases:
+            self.assertIsNotNone(actions[action](item), 'Save {0} into the filter ok'.format(item))
 
             # Make sure that all items are in the bucket
-            self.assertEqual(cuckoo.contains(item), case['included'], 'Item {0} is in the filter'.format(item))
-            self.assertEqual(item in cuckoo, case['included'], 'Item {0} is in the bucket'.format(item))
+            self.assertEqual(cuckoo.contains(item), included, 'Item {0} is in the filter'.format(item))
+            self.assertEqual(item in cuckoo, included, 'Item {0} is in the bucket'.format(item))
+
+        items = ['192.168.1.190', _IP['192.168.1.191'], '192.168.1.192', _IP['192.168.1.193']]
+        expected = [True, True, False, False]
+        self.assertEqual(cuckoo.contains_many(items), expected, 'Batch lookup matches single lookups')
+        self.assertEqual(cuckoo.contains_many([]), [], 'Nothing to look up')
+
+
+    def test_frozen_filter(self):
+        '''
+        A scalable filter stops using its filters which fail to insert an item.
+        '''
+        cuckoo = ScalableCuckooFilter(2, 0.000001, bucket_size=1)
+
+        items = [str(i) for i in range(300)]
+        for item in items:
+            cuckoo.insert(item)
+
+        # pylint: disable=protected-access
+        frozen = sorted(cuckoo._frozen)
+        self.assertTrue(frozen, 'Some filters have failed to insert an item')
+
+        sizes = [cuckoo.filters[position].size for position in frozen]
+        for i in range(300, 400):
+            cuckoo.insert(str(i))
+
+        self.assertEqual([cuckoo.filters[position].size for position in frozen], sizes, 'Frozen filters are not used')
+
+        # Removing an item makes the filter usable again
+        position = frozen[0]
+        for item in items:
+            if cuckoo.delete(item) and position not in cuckoo._frozen:
+                break
+
+        self.assertNotIn(position, cuckoo._frozen, 'The filter is not frozen anymore')
+        self.assertTrue(all(cuckoo.contains(str(i)) for i in range(300, 400)), 'All new items are in the filter')
@@ -2,13 +2,29 @@
 Test serialize and de-serialize the filter using pickle
 '''
 
+import sys
 import unittest
 import pickle
 
+try:
+    from pickle import PickleBuffer
+except ImportError:
+    PickleBuffer = None
+
 from netaddr import IPAddress
+from cuckoo.bucket import Bucket
 from cuckoo.filter import CuckooFilter, BCuckooFilter, ScalableCuckooFilter
 
 
+# Convert the IP addresses used by the tests into their integer format only
+# once instead of in every test case
+_IP = {ip: str(int(IPAddress(ip))) for ip in ('192.168.1.{}'.format(i) for i in range(190, 196))}
+
+# The action of a test case, an index into the tuple of actions of the tested
+# filter
+INSERT, DELETE = 0, 1
+
+
 class SerializationTest(unittest.TestCase):
     '''
     Test various implementation of Cuckoo filters.
@@ -24,70 +40,33 @@ class SerializationTest(unittest.TestCase):
 
         cuckoo = CuckooFilter(capacity, error_rate)
 
-        # By default, a bucket has the capacity of 4
-        cases = [
-            {
-                'item': '192.168.1.190',
-                'transformer': lambda string: string,
-                'action': cuckoo.insert,
-            },
-
-            {
-                'item': '192.168.1.191',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-                'action': cuckoo.insert,
-            },
-
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-                'action': cuckoo.delete,
-            },
-
+        # Each case is an item and the action.  By default, a bucket has the
+        # capacity of 4
+        cases = (
+            ('192.168.1.190', INSERT),
+            (_IP['192.168.1.191'], INSERT),
+            ('192.168.1.192', INSERT),
+            (_IP['192.168.1.193'], INSERT),
+            ('192.168.1.192', DELETE),
             # Add the same item again
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-            },
-
+            (_IP['192.168.1.193'], INSERT),
             # Remove a duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.delete,
-            },
-
+            (_IP['192.168.1.193'], DELETE),
             # Remove the last copy of the duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.delete,
-            },
-        ]
+            (_IP['192.168.1.193'], DELETE),
+        )
 
         self.results = {
             '192.168.1.190': True,
-            str(int(IPAddress('192.168.1.191'))): True,
+            _IP['192.168.1.191']: True,
             '192.168.1.192': False,
-            str(int(IPAddress('192.168.1.193'))): False,
+            _IP['192.168.1.193']: False,
         }
 
-        for case in cases:
-            item = case['transformer'](case['item'])
-            self.assertTrue(case['action'](item), 'Insert / delete {0} from the filter ok'.format(item))
+        actions = (cuckoo.insert, cuckoo.delete)
+
+        for item, action in cases:
+            self.assertTrue(actions[action](item), 'Insert / delete {0} from the filter ok'.format(item))
 
         # Dump and load the filter using pickle
         filter_reload = pickle.loads(pickle.dumps(cuckoo))
@@ -100,12 +79,11 @@ class SerializationTest(unittest.TestCase):
         # Test the bitarray Cuckoo filter
         bcuckoo = BCuckooFilter(capacity, error_rate)
 
-        for case in cases:
-            # Use the method from bit array Cuckoo filter
-            case['action'] = bcuckoo.insert if case['action'] == cuckoo.insert else bcuckoo.delete
+        # Use the methods from bit array Cuckoo filter
+        actions = (bcuckoo.insert, bcuckoo.delete)
 
-            item = case['transformer'](case['item'])
-            self.assertTrue(case['action'](item), 'Insert / delete {0} from the filter ok'.format(item))
+        for item, action in cases:
+            self.assertTrue(actions[action](item), 'Insert / delete {0} from the filter ok'.format(item))
 
         bfilter_reload = pickle.loads(pickle.dumps(bcuckoo))
 
@@ -126,74 +104,139 @@ class SerializationTest(unittest.TestCase):
 
         cuckoo = ScalableCuckooFilter(capacity, error_rate, bucket_size=1)
 
-        # By default, a bucket has the capacity of 4
-        cases = [
-            {
-                'item': '192.168.1.190',
-                'transformer': lambda string: string,
-                'action': cuckoo.insert,
-            },
-
-            {
-                'item': '192.168.1.191',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-                'action': cuckoo.insert,
-            },
-
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-            },
-
-            {
-                'item': '192.168.1.192',
-                'transformer': lambda string: string,
-                'action': cuckoo.delete,
-            },
-
+        # Each case is an item and the action.  By default, a bucket has the
+        # capacity of 4
+        cases = (
+            ('192.168.1.190', INSERT),
+            (_IP['192.168.1.191'], INSERT),
+            ('192.168.1.192', INSERT),
+            (_IP['192.168.1.193'], INSERT),
+            ('192.168.1.192', DELETE),
             # Add the same item again
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.insert,
-            },
-
+            (_IP['192.168.1.193'], INSERT),
             # Remove a duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.delete,
-            },
-
+            (_IP['192.168.1.193'], DELETE),
             # Remove the last copy of the duplicated item
-            {
-                'item': '192.168.1.193',
-                'transformer': lambda string: str(int(IPAddress(string))),
-                'action': cuckoo.delete,
-            },
-        ]
+            (_IP['192.168.1.193'], DELETE),
+        )
 
         self.results = {
             '192.168.1.190': True,
-            str(int(IPAddress('192.168.1.191'))): True,
+            _IP['192.168.1.191']: True,
             '192.168.1.192': False,
-            str(int(IPAddress('192.168.1.193'))): False,
+            _IP['192.168.1.193']: False,
         }
 
-        for case in cases:
-            item = case['transformer'](case['item'])
-            self.assertIsNotNone(case['action'](item), 'Save {0} into the filter ok'.format(item))
+        actions = (cuckoo.insert, cuckoo.delete)
 
-        filter_reload = pickle.loads(pickle.dumps(cuckoo))
+        for item, action in cases:
+            self.assertIsNotNone(actions[action](item), 'Save {0} into the filter ok'.format(item))
 
-        for item, exists in self.results.items():
-            # Make sure that all items are in the bucket
-            self.assertEqual(filter_reload.contains(item), exists, 'Item {0} is in the filter'.format(item))
-            self.assertEqual(item in filter_reload, exists, 'Item {0} is in the bucket'.format(item))
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            filter_reload = pickle.loads(pickle.dumps(cuckoo, protocol=protocol))
+            self.assertEqual(len(filter_reload.filters), len(cuckoo.filters), 'Protocol {0} works'.format(protocol))
+
+            for item, exists in self.results.items():
+                # Make sure that all items are in the bucket
+                self.assertEqual(filter_reload.contains(item), exists, 'Item {0} is in the filter'.format(item))
+                self.assertEqual(item in filter_reload, exists, 'Item {0} is in the bucket'.format(item))
+
+            self.assertEqual(filter_reload.contains_many(list(self.results)), list(self.results.values()),
+                             'Batch lookup after reloading is ok')
+
+
+    @unittest.skipIf(PickleBuffer is None, 'Pickle protocol 5 requires Python 3.8')
+    def test_serialize_out_of_band(self):
+        '''
+        Pass the fingerprints of the filters out-of-band using pickle protocol 5.
+        '''
+        items = [str(i) for i in range(100)]
+
+        for cls in (CuckooFilter, BCuckooFilter):
+            cuckoo = cls(64, 0.000001)
+            for item in items:
+                cuckoo.insert(item)
+
+            buffers = []
+            data = pickle.dumps(cuckoo, protocol=5, buffer_callback=buffers.append)
+            self.assertEqual(len(buffers), 1, 'All fingerprints are passed in a single buffer')
+
+            filter_reload = pickle.loads(data, buffers=buffers)
+            self.assertEqual(bytes(filter_reload.buckets), bytes(cuckoo.buckets), 'All fingerprints are restored')
+            self.assertEqual(filter_reload.size, cuckoo.size, 'Size of {0} is restored'.format(cls.__name__))
+            self.assertTrue(all(filter_reload.contains(item) for item in items), 'All items are in the filter')
+
+            # The reloaded filter can still be changed
+            filter_reload.insert('192.168.1.1')
+            self.assertTrue(filter_reload.contains('192.168.1.1'), 'Item is added after reloading')
+
+            # Also work with the older protocols
+            for protocol in range(5):
+                filter_reload = pickle.loads(pickle.dumps(cuckoo, protocol=protocol))
+                self.assertEqual(bytes(filter_reload.buckets), bytes(cuckoo.buckets),
+                                 'Protocol {0} works'.format(protocol))
+
+        # Every filter of a scalable filter passes its fingerprints in its own
+        # buffer
+        cuckoo = ScalableCuckooFilter(2, 0.000001, bucket_size=1)
+        for item in items:
+            cuckoo.insert(item)
+
+        buffers = []
+        data = pickle.dumps(cuckoo, protocol=5, buffer_callback=buffers.append)
+        self.assertGreater(len(cuckoo.filters), 1, 'The scalable filter has grown')
+        self.assertEqual(len(buffers), len(cuckoo.filters), 'All fingerprints are passed in one buffer per filter')
+
+        filter_reload = pickle.loads(data, buffers=buffers)
+        self.assertEqual([bytes(f.buckets) for f in filter_reload.filters],
+                         [bytes(f.buckets) for f in cuckoo.filters], 'All fingerprints are restored')
+        self.assertTrue(all(filter_reload.contains(item) for item in items), 'All items are in the scalable filter')
+
+
+    @unittest.skipIf(PickleBuffer is None, 'Pickle protocol 5 requires Python 3.8')
+    def test_serialize_byte_order(self):
+        '''
+        Fingerprints passed out-of-band can come from a machine with a different
+        byte order.
+        '''
+        items = [str(i) for i in range(100)]
+
+        cuckoo = CuckooFilter(64, 0.000001)
+        for item in items:
+            cuckoo.insert(item)
+
+        # Pretend that the filter has been pickled on a machine of the other
+        # byte order, then unpickle it the same way as pickle does
+        load, args, state = cuckoo.__reduce_ex__(5)
+
+        swapped = cuckoo.buckets[:]
+        swapped.byteswap()
+        state['buckets'] = PickleBuffer(swapped)
+        state['byteorder'] = 'big' if sys.byteorder == 'little' else 'little'
+
+        filter_reload = load(*args)
+        filter_reload.__setstate__(state)
+        self.assertEqual(bytes(filter_reload.buckets), bytes(cuckoo.buckets), 'All fingerprints are restored')
+        self.assertTrue(all(filter_reload.contains(item) for item in items), 'All items are in the filter')
+
+
+    def test_serialize_state_version(self):
+        '''
+        A state pickled by another version of the package is refused.
+        '''
+        for cuckoo in (CuckooFilter(128, 0.000001), BCuckooFilter(128, 0.000001),
+                       ScalableCuckooFilter(128, 0.000001), Bucket()):
+            cls = type(cuckoo)
+            cuckoo.insert(1 if cls is Bucket else '192.168.1.190')
+
+            # The state of the current version loads fine
+            filter_reload = pickle.loads(pickle.dumps(cuckoo))
+            self.assertEqual(repr(filter_reload), repr(cuckoo), '{} is restored'.format(cls.__name__))
+
+            state = cuckoo.__getstate__()
+            # Older versions don't have any state version
+            del state['version']
+            self.assertRaises(ValueError, cls.__new__(cls).__setstate__, state)
+            # while the newer ones are unknown
+            state['version'] = 2
+            self.assertRaises(ValueError, cls.__new__(cls).__setstate__, state)